@@ -1,96 +1,422 @@
+import gzip
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import cchardet
+import numpy as np
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+from pandas.tseries.api import guess_datetime_format
+from tsdownsample import MinMaxLTTBDownsampler
 
 st.set_page_config(page_title="Tag Trends", page_icon="📊", layout="wide")
 
+logger = logging.getLogger(__name__)
+
+# a historian CSV, or the .parquet written by merge_factorytalk_clean.py
 DATA_URL = "https://raw.githubusercontent.com/rtatrends/rta-trends-dashboard/refs/heads/main/WF%20with%20current%20data.csv"
 
+# Feedrate-type tags are plotted ×0.001; one case-insensitive pass per tag
+SCALED_TAG_RE = re.compile(r"feedrate|tph|rate", re.IGNORECASE)
+
+# points sent to the browser per trace, about the plot's width in pixels;
+# MinMaxLTTB keeps each bucket's extremes so spikes survive the cut
+MAX_TRACE_POINTS = 2000
+DOWNSAMPLER = MinMaxLTTBDownsampler()
+
+# one colour per trace; its y-axis ticks take the same colour
+COLORS = ("#636EFA", "#EF553B", "#00CC96", "#AB63FA", "#FFA15A",
+          "#19D3F3", "#FF6692", "#B6E880", "#FF97FF", "#FECB52")
+# the first tag's y-axis sits on the left; the rest share this spec and are
+# stacked AXIS_STEP apart to the right of the plot area, closer together once
+# there are enough of them to fill AXIS_SPAN of the figure width
+AXIS_BASE = {"overlaying": "y", "side": "right", "anchor": "free", "showgrid": False}
+AXIS_STEP = 0.06
+AXIS_SPAN = 0.4
+
+# rows shipped to the browser by the raw-data table
+RAW_PREVIEW_ROWS = 5000
+
+# parsed frame is kept on local disk so cold starts skip the CSV download + parse;
+# named after DATA_URL so pointing the app at another source starts a new cache
+CACHE_PATH = Path(tempfile.gettempdir()) / f"wf_data_{hashlib.sha1(DATA_URL.encode()).hexdigest()[:12]}.parquet"
+CACHE_MAX_AGE = 24 * 3600  # seconds
+FETCH_TIMEOUT = 30  # seconds; a hung source must not hang the page
+# ETag of the download behind the cache, so a stale cache is revalidated with a
+# conditional GET (304, no body) instead of a full re-download
+ETAG_PATH = CACHE_PATH.with_suffix(".etag")
+# columns parse_csv() guarantees; a cache written by an older build is re-parsed
+CACHE_COLUMNS = {"Tag", "Value", "Timestamp", "_mod"}
+
 # --- Load data safely
-@st.cache_data
-def load_data():
-    encodings = ["utf-16", "utf-16-le", "utf-8-sig", "latin1"]
-    for enc in encodings:
+def _fetch_bytes(url, etag=None):
+    # returns (body, etag); body is None when the server answers 304 Not Modified
+    headers = {"Accept-Encoding": "gzip"}
+    if etag:
+        headers["If-None-Match"] = etag
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=FETCH_TIMEOUT) as resp:
+            body = resp.read()
+            if resp.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            return body, resp.headers.get("ETag")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, etag
+        raise
+
+
+def _sniff_encoding(raw):
+    # a byte-order mark settles it; otherwise detect from a sample, no trial parses
+    if raw[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return "utf-16"  # codec consumes the BOM and picks the byte order
+    if raw[:3] == b"\xef\xbb\xbf":
+        return "utf-8-sig"
+    # a plain-ASCII sample says nothing about later bytes; utf-8 is its superset
+    guess = cchardet.detect(raw[:65536])["encoding"]
+    return "utf-8" if guess in (None, "ASCII") else guess
+
+
+def find_columns(names):
+    # lower-cased name -> original, plus the tag/value/time columns picked from it
+    columns = {c.strip().lower(): c for c in names}
+    tag_col = next((c for c in columns if "tag" in c or "name" in c), None)
+    val_col = next((c for c in columns if "value" in c), None)
+    time_col = next((c for c in columns if "time" in c), None)
+
+    if not tag_col or not val_col:
+        st.error(f"Missing expected columns. Found: {list(columns)}")
+        st.stop()
+    return columns, tag_col, val_col, time_col
+
+
+def parse_csv(raw):
+    # strict decoding: a wrong guess fails the load rather than turning text into �
+    read_opts = dict(encoding=_sniff_encoding(raw), on_bad_lines="skip")
+    try:
+        sample = pd.read_csv(io.BytesIO(raw), nrows=1, **read_opts)
+    except Exception:
+        st.error("❌ Could not load CSV file.")
+        st.stop()
+
+    columns, tag_col, val_col, time_col = find_columns(sample.columns)
+
+    # Pin the timestamp layout from the first row so every row goes through one
+    # strptime format instead of per-element inference.
+    time_fmt = None
+    if time_col and len(sample):
+        time_fmt = guess_datetime_format(str(sample[columns[time_col]].iloc[0]))
+
+    # Fixed schema instead of dtype inference. The C parser is used because the
+    # historian quotes values like "153,803.95", which pyarrow has no thousands=
+    # option for. The fallback leaves Value untyped so stray text gets coerced
+    # below rather than failing the load.
+    typed = {columns[tag_col]: "category", columns[val_col]: "float64"}
+    attempts = [
+        dict(engine="c", dtype=typed),
+        dict(engine="python", dtype={columns[tag_col]: "category"}),
+    ]
+    for opts in attempts:
         try:
-            df = pd.read_csv(DATA_URL, encoding=enc, on_bad_lines="skip", engine="python")
+            df = pd.read_csv(
+                io.BytesIO(raw),
+                thousands=",",
+                parse_dates=[columns[time_col]] if time_col else None,
+                date_format=time_fmt,
+                cache_dates=True,
+                **read_opts,
+                **opts,
+            )
             break
         except Exception:
             continue
     else:
         st.error("❌ Could not load CSV file.")
         st.stop()
+    return tidy(df, tag_col, val_col, time_col, time_fmt)
 
-    # normalize column names
-    df.columns = [c.strip().lower() for c in df.columns]
-    tag_col = next((c for c in df.columns if "tag" in c or "name" in c), None)
-    val_col = next((c for c in df.columns if "value" in c), None)
-    time_col = next((c for c in df.columns if "time" in c), None)
 
-    if not tag_col or not val_col:
-        st.error(f"Missing expected columns. Found: {df.columns.tolist()}")
+def parse_parquet(raw):
+    # output of merge_factorytalk_clean.py: already typed, so no sniffing or
+    # text parsing, just the same normalisation as a CSV
+    try:
+        df = pd.read_parquet(io.BytesIO(raw), engine="pyarrow")
+    except Exception:
+        st.error("❌ Could not load Parquet file.")
         st.stop()
+    _, tag_col, val_col, time_col = find_columns(df.columns)
+    return tidy(df, tag_col, val_col, time_col)
 
+
+def tidy(df, tag_col, val_col, time_col, time_fmt=None):
+    df.columns = df.columns.str.strip().str.lower()
     df.rename(columns={tag_col: "Tag", val_col: "Value"}, inplace=True)
     if time_col:
         df.rename(columns={time_col: "Timestamp"}, inplace=True)
-        df["Timestamp"] = pd.to_datetime(df["Timestamp"], errors="coerce")
+        df["Timestamp"] = pd.to_datetime(df["Timestamp"], format=time_fmt, errors="coerce")
     else:
         df["Timestamp"] = pd.date_range("2025-01-01", periods=len(df), freq="T")
+    # historian samples are millisecond-stamped; ns resolution buys nothing
+    df["Timestamp"] = df["Timestamp"].astype("datetime64[ms]")
+    # pass-through columns (Unit, Quality, ...) may mix text and numbers, which
+    # Parquet can't store in one column
+    for col in df.columns.drop(["Tag", "Value", "Timestamp"]):
+        if df[col].dtype == object:
+            df[col] = df[col].astype("string")
+
+    # float64: feedrates like 153,803.95 carry more digits than float32 holds
+    df["Value"] = pd.to_numeric(df["Value"], errors="coerce").astype("float64")
+    df = df.dropna(subset=["Value", "Tag", "Timestamp"])
+    df["Tag"] = df["Tag"].astype("category").cat.remove_unused_categories()
+    # each tag's rows contiguous and in time order: the plot's groupby then
+    # slices runs of category codes
+    df = df.sort_values(["Tag", "Timestamp"], kind="stable").reset_index(drop=True)
+    # minutes since midnight, so the time-of-day filter is a plain int compare;
+    # the time inputs are minute-resolution and 0..1439 fits 2 bytes a row
+    epoch_min = df["Timestamp"].to_numpy().astype("datetime64[m]").astype("int64")
+    df["_mod"] = (epoch_min % 1440).astype("uint16")
+    return df
+
 
-    df["Value"] = pd.to_numeric(df["Value"], errors="coerce")
-    return df.dropna(subset=["Value", "Tag"])
+def read_cache():
+    # the cached frame, fresh or stale; None if absent, unreadable or from an
+    # older build, all of which just mean a refetch
+    try:
+        df = pd.read_parquet(CACHE_PATH, engine="pyarrow")
+    except Exception:
+        return None
+    if not CACHE_COLUMNS <= set(df.columns) or df["Value"].dtype != "float64":
+        return None
+    return df
 
 
-df = load_data()
+def write_cache(df):
+    # written beside the cache and renamed over it, so an interrupted write or a
+    # full disk never leaves a truncated file at CACHE_PATH
+    fd, tmp = tempfile.mkstemp(dir=CACHE_PATH.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp, engine="pyarrow", compression="zstd", index=False)
+        os.replace(tmp, CACHE_PATH)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+# one shared, read-only frame: no pickle round-trip per rerun as with cache_data.
+# The ttl makes a long-running server re-check the disk cache (and through it
+# the source) hourly; a reload within CACHE_MAX_AGE is just a Parquet read.
+@st.cache_resource(ttl=3600, show_spinner="Loading data…")
+def load_data():
+    df = read_cache()
+    if df is None or time.time() - CACHE_PATH.stat().st_mtime >= CACHE_MAX_AGE:
+        etag = ETAG_PATH.read_text() if df is not None and ETAG_PATH.exists() else None
+        try:
+            raw, etag = _fetch_bytes(DATA_URL, etag)
+        except Exception:
+            if df is None:
+                st.error(f"❌ Could not load {'Parquet' if DATA_URL.endswith('.parquet') else 'CSV'} file.")
+                st.stop()
+            # source unreachable: keep serving the stale frame, retried next ttl
+            st.warning("⚠️ Could not refresh data; showing the last cached copy.")
+        else:
+            if raw is None:
+                CACHE_PATH.touch()  # source unchanged; restart the cache's clock
+            else:
+                df = parse_parquet(raw) if DATA_URL.endswith(".parquet") else parse_csv(raw)
+                try:
+                    write_cache(df)
+                except Exception:
+                    # the cache only saves the next cold start; serve the parsed frame
+                    logger.warning("Could not write data cache %s", CACHE_PATH, exc_info=True)
+                else:
+                    if etag:
+                        ETAG_PATH.write_text(etag)
+                    else:
+                        ETAG_PATH.unlink(missing_ok=True)
+
+    # computed once per load rather than per rerun: the sidebar's range defaults
+    # and each tag's plot scale
+    tag_scale = {tag: 0.001 if SCALED_TAG_RE.search(tag) else 1 for tag in df["Tag"].cat.categories}
+    return df, df["Timestamp"].min(), df["Timestamp"].max(), tag_scale, day_runs(df)
+
+
+def day_runs(df):
+    # Rows are sorted by (Tag, Timestamp), so each tag's rows for one calendar
+    # day are a contiguous run in which _mod only increases. Numbering the runs
+    # and offsetting _mod by run * 1440 gives a non-decreasing key that a
+    # time-of-day window can be searchsorted into, one bound pair per run.
+    epoch_min = df["Timestamp"].to_numpy().astype("datetime64[m]").astype("int64")
+    day = epoch_min // 1440
+    code = df["Tag"].cat.codes.to_numpy()
+    starts = np.empty(len(df), np.bool_)
+    starts[:1] = True
+    starts[1:] = (code[1:] != code[:-1]) | (day[1:] != day[:-1])
+    run = np.cumsum(starts) - 1
+    n_runs = run[-1] + 1 if len(run) else 0
+    return run * 1440 + df["_mod"].to_numpy(), np.arange(n_runs) * 1440
+
+
+def minute_of_day(t):
+    return t.hour * 60 + t.minute
+
+
+def _concat_ranges(lo, hi):
+    # np.concatenate([np.arange(l, h) for l, h in zip(lo, hi)]) without the loop:
+    # a run of +1 steps per range, with a jump to the next range's start
+    keep = hi > lo
+    lo, n = lo[keep], (hi - lo)[keep]
+    if not len(n):
+        return np.empty(0, np.int64)
+    steps = np.ones(n.sum(), np.int64)
+    steps[0] = lo[0]
+    steps[np.cumsum(n)[:-1]] = lo[1:] - (lo[:-1] + n[:-1] - 1)
+    return np.cumsum(steps)
+
+
+# keyed on the window bounds (plus the data's last stamp, which moves when the
+# source refreshes) so Streamlit hashes three scalars rather than the frame
+@st.cache_data(show_spinner=False, max_entries=32)
+def filter_by_time(_df, _runs, data_end, start_m, end_m):
+    if start_m >= end_m:
+        # wraps past midnight: two ranges per run, so one mask pass is simpler
+        mod = _df["_mod"].to_numpy()
+        return _df[(mod >= start_m) | (mod <= end_m)]
+    # a binary search per (tag, day) run and a gather of contiguous slices,
+    # rather than testing every row
+    key, run_base = _runs
+    lo = np.searchsorted(key, run_base + start_m, side="left")
+    hi = np.searchsorted(key, run_base + end_m, side="right")
+    return _df.take(_concat_ranges(lo, hi))
+
+
+df, min_time, max_time, tag_scale, runs = load_data()
 
 # --- Sidebar filters
 st.sidebar.header("⏱ Time Range")
-min_time, max_time = df["Timestamp"].min(), df["Timestamp"].max()
 
 start_time = st.sidebar.time_input("Start Time", min_time.time())
 end_time = st.sidebar.time_input("End Time", max_time.time())
 
-if start_time < end_time:
-    df_filtered = df[(df["Timestamp"].dt.time >= start_time) & (df["Timestamp"].dt.time <= end_time)]
+# The default window spans every row, so use the frame as-is. Data under a day
+# long is covered by its own first-to-last minute even when it crosses midnight
+# (the window then wraps); single-date data by any bounds around it.
+start_m, end_m = minute_of_day(start_time), minute_of_day(end_time)
+window = (max_time, start_m, end_m)
+if (
+    max_time - min_time < pd.Timedelta(days=1)
+    and (start_m, end_m) == (minute_of_day(min_time), minute_of_day(max_time))
+) or (
+    min_time.date() == max_time.date() and start_time <= min_time.time() and end_time >= max_time.time()
+):
+    df_filtered = df
 else:
-    df_filtered = df[(df["Timestamp"].dt.time >= start_time) | (df["Timestamp"].dt.time <= end_time)]
+    df_filtered = filter_by_time(df, runs, *window)
 
 # --- Tag selector
 st.title("📊 Tag Trends")
 st.markdown("Each selected tag is plotted with its own Y-axis scale. Feedrate-type tags (Feedrate, TPH, Rate) are automatically scaled ×0.001.")
 
-available_tags = sorted(df["Tag"].unique())
-selected_tags = st.multiselect("Select Tags to Display", available_tags, default=available_tags[:3])
+available_tags = sorted(df["Tag"].cat.categories.tolist())
 
-if df_filtered.empty:
-    st.warning("⚠️ No data found in this range.")
-elif not selected_tags:
-    st.info("Select tags to visualize trends.")
-else:
-    plot_df = pd.DataFrame()
-    for tag in selected_tags:
-        sub = df_filtered[df_filtered["Tag"] == tag].copy()
-        if sub.empty:
+
+# One figure per (tags, window): reruns that land on an earlier selection reuse
+# the built figure instead of downsampling and assembling it again. A resource
+# cache, so the figure is shared rather than pickled per hit; st.plotly_chart
+# only reads it. The frame and scales are fixed by data_end, so not hashed.
+@st.cache_resource(max_entries=32, show_spinner=False)
+def build_figure(_df_filtered, _tag_scale, tags, data_end, start_m, end_m):
+    # plotly's import graph is heavy; only pay for it once there is a plot
+    import plotly.graph_objects as go
+    import plotly.io as pio
+
+    ts = _df_filtered["Timestamp"].to_numpy()
+    ts_int = ts.view("int64")
+    # one hash partition of the rows instead of a full Tag scan per trace
+    tag_rows = _df_filtered.groupby("Tag", observed=True, sort=False).indices
+    values = _df_filtered["Value"].to_numpy()
+
+    # the spec below is built from known-good values, so Plotly's per-property
+    # validation (and its magic-underscore expansion) is skipped
+    traces = []
+    for tag in tags:
+        idx = tag_rows.get(tag)
+        if idx is None:
             continue
-        scale = 0.001 if any(k in tag.lower() for k in ["feedrate", "tph", "rate"]) else 1
-        sub["ScaledValue"] = sub["Value"] * scale
-        sub["ScaledTag"] = f"{tag} (×{scale})" if scale != 1 else tag
-        plot_df = pd.concat([plot_df, sub])
-
-    if not plot_df.empty:
-        fig = px.line(
-            plot_df,
-            x="Timestamp",
-            y="ScaledValue",
-            color="ScaledTag",
-            labels={"ScaledValue": "Value", "Timestamp": "Timestamp"},
-            template="plotly_dark",
-        )
-        fig.update_layout(height=750, hovermode="x unified", legend_title_text="Tags")
-        st.plotly_chart(fig, use_container_width=True)
+        if len(idx) > MAX_TRACE_POINTS:
+            idx = idx[DOWNSAMPLER.downsample(ts_int[idx], values[idx], n_out=MAX_TRACE_POINTS)]
+        scale = _tag_scale[tag]
+        y = values[idx]
+        if scale != 1:
+            y = y * scale
+        n = len(traces) + 1
+        traces.append(go.Scattergl(
+            # ISO strings via numpy, for the kept points only
+            x=ts[idx].astype("datetime64[ms]").astype(str),
+            y=y,
+            mode="lines",
+            name=f"{tag} (×{scale})" if scale != 1 else tag,
+            line=dict(color=COLORS[(n - 1) % len(COLORS)]),
+            yaxis="y" if n == 1 else f"y{n}",
+            _validate=False,
+        ))
+    if not traces:
+        return None
+
+    # one y-axis per tag
+    step = min(AXIS_STEP, AXIS_SPAN / max(len(traces) - 1, 1))
+    plot_right = 1 - step * (len(traces) - 1)
+    axes = {"yaxis": {"tickfont": {"color": COLORS[0]}}}
+    for n in range(2, len(traces) + 1):
+        axes[f"yaxis{n}"] = {
+            **AXIS_BASE,
+            "tickfont": {"color": COLORS[(n - 1) % len(COLORS)]},
+            "position": plot_right + step * (n - 2),
+        }
+    return go.Figure(
+        data=traces,
+        layout=dict(
+            template=pio.templates["plotly_dark"],
+            height=750,
+            hovermode="x unified",
+            legend=dict(title=dict(text="Tags")),
+            xaxis=dict(title=dict(text="Timestamp"), domain=[0, plot_right]),
+            **axes,
+        ),
+        _validate=False,
+    )
+
+
+# tag picks rerun only this fragment; the time range above still reruns the page
+@st.fragment
+def render_trends(df_filtered, window, available_tags, tag_scale):
+    default_tags = [t for t in available_tags if "feed" in t.lower() or "current" in t.lower()]
+    selected_tags = st.multiselect("Select Tags to Display", available_tags, default=default_tags or available_tags[:3])
+
+    if df_filtered.empty:
+        st.warning("⚠️ No data found in this range.")
+    elif not selected_tags:
+        st.info("Select tags to visualize trends.")
     else:
-        st.warning("No matching data for selected tags.")
+        fig = build_figure(df_filtered, tag_scale, tuple(selected_tags), *window)
+        if fig is not None:
+            st.plotly_chart(fig, theme=None)
+        else:
+            st.warning("No matching data for selected tags.")
+
+
+render_trends(df_filtered, window, available_tags, tag_scale)
 
 # --- Optional raw data viewer
 with st.expander("View Raw Data"):
-    st.dataframe(df_filtered)
+    st.dataframe(df_filtered.head(RAW_PREVIEW_ROWS).drop(columns="_mod"))
+    if len(df_filtered) > RAW_PREVIEW_ROWS:
+        st.caption(f"Showing first {RAW_PREVIEW_ROWS:,} of {len(df_filtered):,} rows")
@@ -1,34 +1,84 @@
 # 🧩 Merge FactoryTalk CSVs (raw + clean tag names, no scaling, auto-download)
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
+import pyarrow as pa
+from pandas.api.types import union_categoricals
+from pandas.tseries.api import guess_datetime_format
 from google.colab import files
-import re
 
 print("📂 Upload historian CSVs (TT-01, Motors, Flow, WF optional)")
 uploaded = files.upload()
 
-def clean_name(full):
-    full = str(full)
-    tag = re.split(r"[./]", full)[-1]
-    return tag.strip()
-
 def clean_csv(path):
-    df = pd.read_csv(path, encoding="utf-16", on_bad_lines="skip")
-    df.columns = [c.strip().title() for c in df.columns]
-    df = df[[c for c in ['Time','Name','Value','Quality'] if c in df.columns]].copy()
-    df['Time']  = pd.to_datetime(df['Time'], errors='coerce')
+    # only the wanted columns get parsed (pyarrow's usecols takes names, not a
+    # callable, hence the header peek); Name/Quality are read as text so every
+    # upload's categories share one dtype, even a numeric or empty Quality
+    header = pd.read_csv(path, encoding="utf-16", nrows=0).columns
+    titled = header.str.strip().str.title()
+    wanted = titled.isin(['Time','Name','Value','Quality'])
+    keep = dict(zip(header[wanted], titled[wanted]))
+    # pyarrow's multithreaded reader; it has no thousands= option, so Value
+    # arrives as text whenever the historian quoted a "153,803.95"
+    df = pd.read_csv(path, engine="pyarrow", encoding="utf-16", on_bad_lines="skip", usecols=list(keep),
+                     dtype={c: 'string' for c, name in keep.items() if name in ('Name','Quality')})
+    df = df.rename(columns=keep)
+    # a handful of distinct strings repeated per row -> category codes
+    for col in ['Name', 'Quality']:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    # one explicit format for the whole column instead of per-row inference
+    first = df['Time'].dropna()
+    fmt = guess_datetime_format(str(first.iloc[0])) if len(first) else None
+    df['Time']  = pd.to_datetime(df['Time'], format=fmt, errors='coerce')
+    if not pd.api.types.is_numeric_dtype(df['Value']):
+        df['Value'] = df['Value'].str.replace(',', '', regex=False)
     df['Value'] = pd.to_numeric(df['Value'], errors='coerce')
-    df['Tag']   = df['Name'].apply(clean_name)
+    # tag = text after the last '.' or '/'; str ops on a categorical run once per
+    # distinct name, not per row
+    df['Tag']   = df['Name'].str.extract(r'([^./]*)$', expand=False).str.strip().astype('category')
     df.dropna(subset=['Time','Value'], inplace=True)
+    df.sort_values('Time', kind='mergesort', inplace=True)
     return df
 
-frames = [clean_csv(fn) for fn in uploaded.keys()]
+# files.upload() has already saved each file in the working directory, so the
+# workers take paths; with several uploads each one parses in its own process
+paths = list(uploaded.keys())
+cores = os.cpu_count() or 1
+workers = min(len(paths), cores)
+# Fork only: a forked worker inherits clean_csv and skips the upload above,
+# while spawn/forkserver would re-run this script (or, from a notebook, not find
+# clean_csv at all). Each worker's pyarrow reader gets its share of the cores
+# so N processes don't each start a full-size thread pool.
+if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                             initializer=pa.set_cpu_count, initargs=(max(1, cores // workers),)) as pool:
+        frames = list(pool.map(clean_csv, paths))
+else:
+    frames = [clean_csv(fn) for fn in paths]
+# concat keeps category dtype only when every frame shares the same categories
+for col in ['Name', 'Tag', 'Quality']:
+    parts = [f[col] for f in frames if col in f.columns]
+    if parts:
+        cats = union_categoricals(parts).categories
+        for f in frames:
+            if col in f.columns:
+                f[col] = f[col].cat.set_categories(cats)
 combined = pd.concat(frames, ignore_index=True)
-combined.sort_values('Time', inplace=True)
+# every frame is already a sorted run, which the stable sort merges instead of
+# re-sorting from scratch; ties keep upload order
+combined.sort_values('Time', kind='mergesort', inplace=True)
 combined.reset_index(drop=True, inplace=True)
 
 out_name = 'Last_30_Day_Data_Group_45.csv'
 combined.to_csv(out_name, index=False)
 files.download(out_name)
+# typed and compressed copy; point the app's DATA_URL at it to skip CSV parsing
+pq_name = out_name.replace('.csv', '.parquet')
+combined.to_parquet(pq_name, engine='pyarrow', compression='zstd', index=False)
+files.download(pq_name)
 
-print(f"✅ Done: {len(combined):,} rows → {out_name}")
+print(f"✅ Done: {len(combined):,} rows → {out_name}, {pq_name}")
 print('📊 Columns: Time | Name | Value | Quality | Tag')